@@ -1,21 +1,44 @@
 
 
 import json
+import orjson
 import re
-import boto3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from botocore.session import Session
 from lib import env
 from elasticsearch import Elasticsearch, RequestsHttpConnection
+from elasticsearch.helpers import bulk
 from requests_aws4auth import AWS4Auth
-import json
+import logging
+import os
 import os.path
+import sys
+
+
+logger = logging.getLogger(__name__)
+# Fallback to WARNING on an unknown LOG_LEVEL instead of failing to load
+try:
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'WARNING').upper())
+except ValueError:
+    logger.setLevel(logging.WARNING)
+    logger.warning("Invalid LOG_LEVEL: %s", os.environ['LOG_LEVEL'])
 
+# Bulk threads stay below the 10 connections pooled per ES host
+bulk_chunk_size = 500
+bulk_threads = 4
 
-reserved_fields = [ "uid", "_id", "_type", "_source", "_all", "_parent", "_fieldnames", "_routing", "_index", "_size", "_timestamp", "_ttl"]
+table_arn = re.compile(r'arn:aws:dynamodb:[^:]*:[^:]*:table/([0-9a-zA-Z_-]+)/')
+
+# Every reserved field but uid starts with _
+# Only those are renamed, uid has no _ to double and is kept as is
+reserved_fields = frozenset({"uid", "_id", "_type", "_source", "_all", "_parent", "_fieldnames", "_routing", "_index", "_size", "_timestamp", "_ttl"})
 
 
 # Process DynamoDB Stream records and insert the object in ElasticSearch
 # Use the Table name as index and doc_type name
-# Force index refresh upon all actions for close to realtime reindexing
+# All records of an invocation are sent in a single _bulk request
+# Force one index refresh per invocation for close to realtime reindexing
 # Use IAM Role for authentication
 # Properly unmarshal DynamoDB JSON types. Binary NOT tested.
  
@@ -26,145 +49,246 @@ if (os.path.isfile("lib/table_mapping.json")):
     with open('lib/table_mapping.json') as json_file:
         table_mapping = json.load(json_file)
 
-def lambda_handler(event, context):
-
-    session = boto3.session.Session()
-    credentials = session.get_credentials()
+# Key attribute names of each mapped table: (PrimaryKey, SortKey or None)
+# Attributes to index when the table mapping whitelists them in IndexFields
+mapping_keys = {}
+mapping_fields = {}
+if (table_mapping != None):
+    for table_name, mapping in table_mapping.items():
+        table_name = sys.intern(table_name)
+        mapping_keys[table_name] = (mapping["PrimaryKey"],
+                                    mapping.get("SortKey"))
+        if ("IndexFields" in mapping):
+            mapping_fields[table_name] = tuple(mapping["IndexFields"])
+
+# Clients are kept across warm invocations
+session = Session()
+es_client = None
+es_token = None
+known_indices = set()
+
+# Lambda provides the role credentials in its environment
+# Fallback to the botocore credentials chain when running elsewhere
+def get_credentials():
+    if 'AWS_ACCESS_KEY_ID' in os.environ:
+        return (os.environ['AWS_ACCESS_KEY_ID'],
+                os.environ['AWS_SECRET_ACCESS_KEY'],
+                os.environ.get('AWS_SESSION_TOKEN'),
+                os.environ.get('AWS_REGION')
+                or session.get_config_variable('region'))
+
+    credentials = session.get_credentials().get_frozen_credentials()
+    return (credentials.access_key,
+            credentials.secret_key,
+            credentials.token,
+            session.get_config_variable('region'))
+
+# Return the ES client, built again only when the credentials rotated
+# Reusing the AWS4Auth also reuses its signing key, derived once per day
+def get_es_client():
+    global es_client, es_token
+
+    access_key, secret_key, token, region = get_credentials()
+    if es_client is not None and token == es_token:
+        return es_client
 
     # Get proper credentials for ES auth
-    awsauth = AWS4Auth(credentials.access_key,
-                       credentials.secret_key,
-                       session.region_name, 'es',
-                       session_token=credentials.token)
+    awsauth = AWS4Auth(access_key,
+                       secret_key,
+                       region, 'es',
+                       session_token=token)
 
     # Connect to ES
-    es = Elasticsearch(
+    es_client = Elasticsearch(
         [env.ES_ENDPOINT],
         http_auth=awsauth,
         use_ssl=True,
         verify_certs=True,
         connection_class=RequestsHttpConnection
     )
+    es_token = token
 
-    print("Cluster info:")
-    print(es.info())
+    return es_client
 
-    # Loop over the DynamoDB Stream records
+def lambda_handler(event, context):
+
+    es = get_es_client()
+
+    # Loop over the DynamoDB Stream records and build the bulk actions
+    actions = []
+    touched_tables = Counter()
     for record in event['Records']:
 
+        handler = event_handlers.get(record.get('eventName'))
+        if handler is None:
+            continue
+
         try:
-            if record['eventName'] == "INSERT":
-                insert_document(es, record)
-            elif record['eventName'] == "REMOVE":
-                remove_document(es, record)
-            elif record['eventName'] == "MODIFY":
-                modify_document(es, record)
-
-        except Exception as e:
-            print("Failed to process:")
-            print(json.dumps(record))
-            print("ERROR: " + repr(e))
+            action = handler(es, record)
+            actions.append(action)
+            touched_tables[action['_index']] += 1
+
+        except Exception:
+            logger.exception("Failed to process: %s", dumps(record))
             continue
 
-# Process MODIFY events
-def modify_document(es, record):
+    if not actions:
+        return
+
+    # Send all the actions, report per document failures
+    success, errors = send_actions(es, actions)
+    logger.debug("Successly processed %d documents", success)
+    failed_tables = Counter()
+    for error in errors:
+        logger.error("Failed to process: %s", dumps(error))
+        for item in error.values():
+            failed_tables[item.get('_index')] += 1
+
+    # One refresh for the whole batch instead of one per document
+    # Only indexes with at least one successful write are refreshed
+    written_tables = sorted(table for table, count in touched_tables.items()
+                            if count > failed_tables[table])
+    if not written_tables:
+        return
+
+    # The documents are written, a failed refresh must not retry the batch
+    try:
+        es.indices.refresh(index=','.join(written_tables),
+                           ignore_unavailable=True)
+    except Exception:
+        logger.exception("Failed to refresh: %s", ','.join(written_tables))
+
+# Send the actions with the bulk API
+# Batches larger than a chunk are split in lanes sent concurrently
+# All actions of a document go to the same lane to keep the stream order
+def send_actions(es, actions):
+    if len(actions) <= bulk_chunk_size:
+        return send_lane(es, actions)
+
+    lanes = [[] for i in range(bulk_threads)]
+    for action in actions:
+        lanes[hash((action['_index'], action['_id'])) % bulk_threads].append(action)
+
+    success = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=bulk_threads) as executor:
+        for lane_success, lane_errors in executor.map(lambda lane: send_lane(es, lane), lanes):
+            success += lane_success
+            errors.extend(lane_errors)
+
+    return success, errors
+
+def send_lane(es, actions):
+    return bulk(es, actions,
+                chunk_size=bulk_chunk_size,
+                raise_on_error=False,
+                refresh=False,
+                request_timeout=30)
+
+# Read the table, document ID and JSON document of a record
+# Done once per record, the result can be sent to any client
+def prepare_document(record):
     table = getTable(record)
-    print("Dynamo Table: " + table)
-
     docId = generateId(record, table)
-    print("KEY")
-    print(docId)
+
+    # Only keep the whitelisted attributes, if any
+    image = record['dynamodb']['NewImage']
+    fields = mapping_fields.get(table)
+    if (fields != None):
+        image = {key: image[key] for key in fields if key in image}
 
     # Unmarshal the DynamoDB JSON to a normal JSON
-    doc = json.dumps(unmarshalJson(record['dynamodb']['NewImage']))
+    doc = unmarshalJsonString(image)
 
-    print("Updated document:")
-    print(doc)
+    return table, docId, doc
 
-    # We reindex the whole document as ES accepts partial docs
-    es.index(index=table,
-             body=doc,
-             id=docId,
-             doc_type=table,
-             refresh=True)
+# Process MODIFY events
+def modify_document(es, record):
+    table, docId, doc = prepare_document(record)
+    logger.debug("Updated document - Index: %s - Document ID: %s", table, docId)
 
-    print("Successly modified - Index: " + table + " - Document ID: " + docId)
+    # We reindex the whole document as ES accepts partial docs
+    return {'_op_type': 'index',
+            '_index': table,
+            '_type': table,
+            '_id': docId,
+            '_source': doc}
 
 # Process REMOVE events
 def remove_document(es, record):
     table = getTable(record)
-    print("Dynamo Table: " + table)
-
     docId = generateId(record, table)
-    print("Deleting document ID: " + docId)
+    logger.debug("Deleting document - Index: %s - Document ID: %s", table, docId)
 
-    es.delete(index=table,
-              id=docId,
-              doc_type=table,
-              refresh=True)
-
-    print("Successly removed - Index: " + table + " - Document ID: " + docId)
+    return {'_op_type': 'delete',
+            '_index': table,
+            '_type': table,
+            '_id': docId}
 
 # Process INSERT events
 def insert_document(es, record):
-    table = getTable(record)
-    print("Dynamo Table: " + table)
-
-    # Create index if missing
-    if es.indices.exists(table) == False:
-        print("Create missing index: " + table)
-
-        es.indices.create(table,
-                          body='{"settings": { "index.mapping.coerce": true } }')
-
-        print("Index created: " + table)
-
-    # Unmarshal the DynamoDB JSON to a normal JSON
-    doc = json.dumps(unmarshalJson(record['dynamodb']['NewImage']))
-
-    print("New document to Index:")
-    print(doc)
-
-    newId = generateId(record, table)
-    es.index(index=table,
-             body=doc,
-             id=newId,
-             doc_type=table,
-             refresh=True)
-
-    print("Successly inserted - Index: " + table + " - Document ID: " + newId)
+    table, docId, doc = prepare_document(record)
+    logger.debug("New document - Index: %s - Document ID: %s", table, docId)
+
+    # The index is created before the bulk request is sent
+    create_index(es, table)
+
+    return {'_op_type': 'index',
+            '_index': table,
+            '_type': table,
+            '_id': docId,
+            '_source': doc}
+
+event_handlers = {
+    "INSERT": insert_document,
+    "MODIFY": modify_document,
+    "REMOVE": remove_document,
+}
+
+# Create index if missing
+# An existing index answers 400 resource_already_exists_exception, ignored
+# Known indexes are remembered across warm invocations
+def create_index(es, table):
+    if table in known_indices:
+        return
+
+    response = es.indices.create(table,
+                                 body='{"settings": { "index.mapping.coerce": true } }',
+                                 ignore=400)
+
+    # Any other 400 is logged and the index is tried again next time
+    error = response.get('error')
+    if (error != None
+        and not (isinstance(error, dict)
+                 and error.get('type') == 'resource_already_exists_exception')):
+        logger.error("Failed to create index %s: %s", table, dumps(error))
+        return
+
+    logger.debug("Index ready: %s", table)
+
+    known_indices.add(table)
 
 # Return the dynamoDB table that received the event. Lower case it
 def getTable(record):
-    p = re.compile('arn:aws:dynamodb:.*?:.*?:table/([0-9a-zA-Z_-]+)/.+')
-    m = p.match(record['eventSourceARN'])
+    m = table_arn.match(record['eventSourceARN'])
     if m is None:
         raise Exception("Table not found in SourceARN")
-    return m.group(1).lower()
+    return sys.intern(m.group(1).lower())
 
 # Generate the ID for ES. Used for deleting or updating item later
 # By default using keys given by the dynamo stream
 # If a mapping is there, it's used to create the id
 def generateId(record, table_name):
     keys = unmarshalJson(record['dynamodb']['Keys'])
-    if (table_mapping != None
-        and table_name in table_mapping.keys()):
-        print("Use mapping")
-        if ("SortKey" in table_mapping[table_name]):
-            return(str(keys[table_mapping[table_name]["PrimaryKey"]])+"|"+str(keys[table_mapping[table_name]["SortKey"]]))
-        else:
-            return(str(keys[table_mapping[table_name]["PrimaryKey"]]))
+    mapping = mapping_keys.get(table_name)
+    if (mapping != None):
+        primary_key, sort_key = mapping
+        if (sort_key != None):
+            return f"{keys[primary_key]}|{keys[sort_key]}"
+        return str(keys[primary_key])
 
     # Concat HASH and RANGE key with | in between
-    newId = ""
-    i = 0
-    for key, value in list(keys.items()):
-        if (i > 0):
-            newId += "|"
-        newId += str(value)
-        i += 1
-
-    return newId
+    return "|".join(str(value) for value in keys.values())
 
 # Unmarshal a JSON that is DynamoDB formatted
 def unmarshalJson(node):
@@ -173,41 +297,167 @@ def unmarshalJson(node):
     return unmarshalValue(data, True)
 
 # ForceNum will force float or Integer to
+# A DynamoDB node holds a single type tag, dispatched to its handler
 def unmarshalValue(node, forceNum=False):
-    for key, value in list(node.items()):
-        if (key == "NULL"):
+    for key in node:
+        handler = unmarshal_handlers.get(key)
+        if handler is None:
             return None
-        if (key == "S" or key == "BOOL"):
-            return value
-        if (key == "N"):
-            if (forceNum):
-                return int_or_float(value)
-            return value
-        if (key == "M"):
-            data = {}
-            for key1, value1 in list(value.items()):
-                if key1 in reserved_fields:
-                    key1 = key1.replace("_", "__", 1)
-                data[key1] = unmarshalValue(value1, True)
-            return data
-        if (key == "BS" or key == "L"):
-            data = []
-            for item in value:
-                data.append(unmarshalValue(item))
-            return data
-        if (key == "SS"):
-            data = []
-            for item in value:
-                data.append(item)
-            return data
-        if (key == "NS"):
-            data = []
-            for item in value:
-                if (forceNum):
-                    data.append(int_or_float(item))
-                else:
-                    data.append(item)
-            return data
+        return handler(node[key], forceNum)
+
+def unmarshalNull(value, forceNum):
+    return None
+
+def unmarshalScalar(value, forceNum):
+    return value
+
+def unmarshalNumber(value, forceNum):
+    if (forceNum):
+        return int_or_float(value)
+    return value
+
+# Reserved keys are renamed the same way in writeMap
+def unmarshalMap(value, forceNum):
+    data = {}
+    for key, item in value.items():
+        if key[:1] == "_" and key in reserved_fields:
+            key = key.replace("_", "__", 1)
+        data[key] = unmarshalValue(item, True)
+    return data
+
+def unmarshalList(value, forceNum):
+    return [unmarshalValue(item) for item in value]
+
+def unmarshalStringSet(value, forceNum):
+    return list(value)
+
+def unmarshalNumberSet(value, forceNum):
+    if (forceNum):
+        return [int_or_float(item) for item in value]
+    return list(value)
+
+# Keep in sync with write_handlers, both walks must handle the same tags
+unmarshal_handlers = {
+    "NULL": unmarshalNull,
+    "S": unmarshalScalar,
+    "BOOL": unmarshalScalar,
+    "N": unmarshalNumber,
+    "M": unmarshalMap,
+    "L": unmarshalList,
+    # Binary set items are base64 strings, kept as strings
+    "BS": unmarshalStringSet,
+    "SS": unmarshalStringSet,
+    "NS": unmarshalNumberSet,
+}
+
+# Write a DynamoDB formatted JSON straight to a normal JSON string
+# Same output as unmarshalJson, without building the document in between
+# The buffer is decoded directly, without an intermediate bytes copy
+def unmarshalJsonString(node):
+    buf = bytearray()
+    writeMap(buf, node, True)
+    return buf.decode()
+
+def writeValue(buf, node, forceNum=False):
+    for key in node:
+        writer = write_handlers.get(key)
+        if writer is None:
+            buf += b'null'
+        else:
+            writer(buf, node[key], forceNum)
+        return
+    buf += b'null'
+
+def writeNull(buf, value, forceNum):
+    buf += b'null'
+
+def writeString(buf, value, forceNum):
+    buf += orjson.dumps(value)
+
+def writeBool(buf, value, forceNum):
+    buf += b'true' if value else b'false'
+
+def writeNumber(buf, value, forceNum):
+    if (forceNum):
+        buf += repr(int_or_float(value)).encode()
+    else:
+        buf += orjson.dumps(value)
+
+# Strings and numbers are the bulk of large items (time series, ...)
+# They are written inline to skip a dispatch call per value
+# Reserved keys are renamed the same way in unmarshalMap
+def writeMap(buf, value, forceNum):
+    buf += b'{'
+    first = True
+    for key, item in value.items():
+        if not first:
+            buf += b','
+        first = False
+        if key[:1] == "_" and key in reserved_fields:
+            key = key.replace("_", "__", 1)
+        buf += orjson.dumps(key)
+        buf += b':'
+        if "S" in item:
+            buf += orjson.dumps(item["S"])
+        elif "N" in item:
+            buf += repr(int_or_float(item["N"])).encode()
+        else:
+            writeValue(buf, item, True)
+    buf += b'}'
+
+# Numbers in lists are kept as strings
+def writeList(buf, value, forceNum):
+    buf += b'['
+    first = True
+    for item in value:
+        if not first:
+            buf += b','
+        first = False
+        if "S" in item:
+            buf += orjson.dumps(item["S"])
+        elif "N" in item:
+            buf += orjson.dumps(item["N"])
+        else:
+            writeValue(buf, item)
+    buf += b']'
+
+def writeStringSet(buf, value, forceNum):
+    buf += orjson.dumps(value)
+
+def writeNumberSet(buf, value, forceNum):
+    if not forceNum:
+        buf += orjson.dumps(value)
+        return
+    buf += b'['
+    first = True
+    for item in value:
+        if not first:
+            buf += b','
+        first = False
+        buf += repr(int_or_float(item)).encode()
+    buf += b']'
+
+# Keep in sync with unmarshal_handlers, both walks must handle the same tags
+write_handlers = {
+    "NULL": writeNull,
+    "S": writeString,
+    "BOOL": writeBool,
+    "N": writeNumber,
+    "M": writeMap,
+    "L": writeList,
+    # Binary set items are base64 strings, kept as strings
+    "BS": writeStringSet,
+    "SS": writeStringSet,
+    "NS": writeNumberSet,
+}
+
+# Serialize to a JSON string with orjson
+# Fallback to json for integers above 64 bits (DynamoDB allows 38 digits)
+def dumps(obj):
+    try:
+        return orjson.dumps(obj).decode()
+    except orjson.JSONEncodeError:
+        return json.dumps(obj)
 
 # Detect number type and return the correct one
 def int_or_float(s):
@@ -1,53 +1,61 @@
 #!/usr/bin/env python3
-import json
+import orjson
+import os.path
 import re
-import boto3
+from botocore.session import Session
 from lib import env
-from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # This script create a json used by the dynamo to eslasticseach lambda
 # More infomations about why how to use it into the README
 
 
-lamdba_client = boto3.client('lambda')
-ddb_client = boto3.client('dynamodb')
+session = Session()
+lamdba_client = session.create_client('lambda')
+ddb_client = session.create_client('dynamodb')
 
 response = lamdba_client.list_event_source_mappings(
     FunctionName='DynamoToES',
     MaxItems=100
 )
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError ("Type %s not serializable" % type(obj))
-
 table_list = {
 	re.search(".+:table\/([a-zA-Z]+)\/.+", event_source["EventSourceArn"]).group(1) : event_source
 	for event_source in response["EventSourceMappings"]
 }
 
-table_mapping = {
-	table_name.lower() : ddb_client.describe_table(TableName=table_name)
-	for (table_name, table) in table_list.items()
-}
-for table_name, table_description in table_mapping.items():
-	temp_key_schema = table_description["Table"]["KeySchema"];
+# Keep the IndexFields whitelists set by hand in the current mapping
+index_fields = {}
+if (os.path.isfile("lib/table_mapping.json")):
+	with open("lib/table_mapping.json", "rb") as f:
+		index_fields = {
+			table_name : mapping["IndexFields"]
+			for (table_name, mapping) in orjson.loads(f.read()).items()
+			if "IndexFields" in mapping
+		}
 
-	primary_key = "";
-	for value in temp_key_schema:
-		primary_key = value["AttributeName"] if value["KeyType"] == "HASH" else primary_key
+# DescribeTable calls are independent, run them concurrently
+def describe_table(table_name):
+	return (table_name.lower(), ddb_client.describe_table(TableName=table_name))
+
+with ThreadPoolExecutor(16) as executor:
+	table_mapping = dict(executor.map(describe_table, table_list))
 
+for table_name, table_description in table_mapping.items():
+	primary_key = "";
 	sort_key = "";
-	for value in temp_key_schema:
-		sort_key = value["AttributeName"] if value["KeyType"] == "RANGE" else sort_key
+	for value in table_description["Table"]["KeySchema"]:
+		if value["KeyType"] == "HASH":
+			primary_key = value["AttributeName"]
+		elif value["KeyType"] == "RANGE":
+			sort_key = value["AttributeName"]
 
 	table_description["PrimaryKey"] = primary_key
 	if(sort_key != ""):
 		table_description["SortKey"] = sort_key
+	if(table_name in index_fields):
+		table_description["IndexFields"] = index_fields[table_name]
 
-f = open("lib/table_mapping.json", "w")
-f.write(json.dumps(table_mapping, default=json_serial,indent=4, sort_keys=True))
-f.close()
+# orjson serializes the DescribeTable dates natively
+with open("lib/table_mapping.json", "wb") as f:
+	f.write(orjson.dumps(table_mapping, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))